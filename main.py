@@ -1,10 +1,11 @@
 import pygame
 import numpy as np
 import csv
+from collections import OrderedDict
 import time
-import importlib
-import importlib.util
+import os
 import sys
+import types
 import math
 from physics import BicyclePhysics
 from practice_track import PRACTICE_TRACK, TIME_LIMIT
@@ -22,6 +23,18 @@ DASHBOARD_BG = (255, 255, 255, 220)
 DASHBOARD_BORDER = (100, 100, 100, 255)
 LABEL_COLOR = (50, 50, 50)
 
+# Number of log rows buffered in memory before being written to disk
+LOG_BATCH_SIZE = 100
+
+# Physics timestep (s) and render frame rate; physics runs in fixed steps between frames
+PHYSICS_DT = 0.01
+RENDER_FPS = 60
+# Upper bound on physics steps per frame, so a slow frame does not snowball
+MAX_STEPS_PER_FRAME = 10
+
+# Maximum number of rendered text surfaces kept in the cache
+TEXT_CACHE_SIZE = 256
+
 class EcoGearSimulator:
     def __init__(self):
         pygame.init()
@@ -31,16 +44,36 @@ class EcoGearSimulator:
         self.font = pygame.font.SysFont('Arial', 24, bold=True)
         self.small_font = pygame.font.SysFont('Arial', 18)
         self.monospace_font = pygame.font.SysFont('Courier New', 22, bold=True)
+        self._text_cache = OrderedDict()  # (text, color, font id) -> rendered surface, in LRU order
+        self._wrapped_status = {}  # (status message, max width) -> wrapped lines
+        
+        # Bike sprite, drawn once and rotated on demand (cached per whole degree)
+        self._bike_base = self.build_bike_sprite()
+        self._rotated_bikes = {}
         
         # Load controller
         self.controller_path = "controller_template.py"
+        self.controller = None
+        self._controller_code = None   # Compiled controller source, reused until the file changes
+        self._controller_mtime = None
         self.load_controller()
         
         # Initialize physics
         self.bike = BicyclePhysics(PRACTICE_TRACK, TIME_LIMIT)
         
+        # Track info passed to the controller (next_segment is refreshed on segment changes)
+        self._track_info = {
+            'segments': self.bike.track_segments,
+            'next_segment': None,
+            'finish_line': self.bike.total_length
+        }
+        
         # Precompute track profile
-        self.track_profile = self.generate_elevation_profile()
+        self.track_xs, self.track_elevs = self.generate_elevation_profile()
+        self.track_mus = self.bike.seg_mus[self.bike.get_segment_indices(self.track_xs)]
+        # Friction of each point as a 0-255 color bucket, and the track color of each bucket
+        self.track_mu_buckets = (np.clip(self.track_mus, 0.0, 1.0) * 255).astype(np.uint8)
+        self._mu_colors = [(int(255 * (1 - b / 255)), b, 0) for b in range(256)]
         
         # Logging
         self.log_file = f"simulation_log_{int(time.time())}.csv"
@@ -52,81 +85,107 @@ class EcoGearSimulator:
         self.show_help = False
         
     def load_controller(self):
-        """Dynamically load user's controller"""
+        """Load user's controller, recompiling the source only if the file changed since the last load"""
         try:
-            spec = importlib.util.spec_from_file_location("controller", self.controller_path)
-            self.controller = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(self.controller)
-            print(f"Loaded controller: {self.controller_path}")
+            mtime = os.stat(self.controller_path).st_mtime_ns
+            if self._controller_code is None or mtime != self._controller_mtime:
+                with open(self.controller_path) as f:
+                    self._controller_code = compile(f.read(), self.controller_path, 'exec')
+                self._controller_mtime = mtime
+            controller = types.ModuleType("controller")
+            controller.__file__ = self.controller_path
+            exec(self._controller_code, controller.__dict__)
         except Exception as e:
             print(f"Error loading controller: {e}")
-            print("Using default controller template")
-            self.controller_path = "controller_template.py"
-            spec = importlib.util.spec_from_file_location("controller", self.controller_path)
-            self.controller = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(self.controller)
+            if self.controller is None:
+                raise
+            print("Keeping previously loaded controller")
+            return
+        self.controller = controller
+        print(f"Loaded controller: {self.controller_path}")
     
     def generate_elevation_profile(self):
-        """Precompute elevation points for rendering"""
-        profile = []
-        elevation = 0.0
+        """Precompute elevation points for rendering as (xs, elevations) arrays"""
+        xs_parts = []
+        dys_parts = []
         last_x = 0.0
         
         for seg in self.bike.track_segments:
             start, end, slope, _ = seg
             segment_length = end - start
             
-            # Fill in points between segments
+            # Fill in points between segments (flat)
             if start > last_x:
-                for x in np.linspace(last_x, start, int((start - last_x) * 10) + 1):
-                    profile.append((x, elevation))
+                gap_xs = np.linspace(last_x, start, int((start - last_x) * 10) + 1)
+                xs_parts.append(gap_xs)
+                dys_parts.append(np.zeros_like(gap_xs))
             
             # Process current segment
-            for x in np.linspace(start, end, int(segment_length * 10) + 1):
-                dx = x - last_x
-                elevation += slope * dx
-                profile.append((x, elevation))
-                last_x = x
+            seg_xs = np.linspace(start, end, int(segment_length * 10) + 1)
+            xs_parts.append(seg_xs)
+            dys_parts.append(slope * np.diff(seg_xs, prepend=last_x))
+            last_x = end
+        
+        if not xs_parts:
+            return np.empty(0), np.empty(0)
         
-        return profile
+        xs = np.concatenate(xs_parts)
+        elevs = np.cumsum(np.concatenate(dys_parts))
+        return xs, elevs
     
     def setup_logger(self):
-        """Initialize CSV logger"""
-        with open(self.log_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                'timestamp', 'x', 'v', 'segment_idx', 'slope', 'mu', 
-                'gear_ratio', 'energy_step', 'total_energy', 'slip_event',
-                'F_drive', 'F_gravity', 'F_drag', 'F_roll'
-            ])
+        """Initialize CSV logger (file is kept open and rows are written in batches)"""
+        self._log_fh = open(self.log_file, 'w', newline='', buffering=1 << 16)
+        self._log_writer = csv.writer(self._log_fh)
+        self._log_writer.writerow([
+            'timestamp', 'x', 'v', 'segment_idx', 'slope', 'mu', 
+            'gear_ratio', 'energy_step', 'total_energy', 'slip_event',
+            'F_drive', 'F_gravity', 'F_drag', 'F_roll'
+        ])
+        self._log_buf = []
     
-    def log_step(self, state):
-        """Log current state to CSV"""
-        if not self.logging_enabled or self.bike.completed or self.bike.failed:
+    def log_step(self):
+        """Buffer the bike's current state for the CSV log"""
+        bike = self.bike
+        if not self.logging_enabled or bike.completed or bike.failed:
             return
         
-        with open(self.log_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                time.time(),
-                state['x'],
-                state['v'],
-                state['segment_idx'],
-                state['slope'],
-                state['mu'],
-                state['gear_ratio'],
-                state['energy_step'],
-                state['total_energy'],
-                state['slip_event'],
-                state['F_drive'],
-                state['F_gravity'],
-                state['F_drag'],
-                state['F_roll']
-            ])
+        self._log_buf.append((
+            time.time(),
+            bike.x,
+            bike.v,
+            bike.last_segment_idx,
+            bike.current_slope,
+            bike.current_mu,
+            bike.gear_ratio,
+            bike.energy_step,
+            bike.total_energy,
+            bike.slip_event,
+            bike.F_drive,
+            bike.F_gravity,
+            bike.F_drag,
+            bike.F_roll
+        ))
+        if len(self._log_buf) >= LOG_BATCH_SIZE:
+            self.flush_log()
+    
+    def flush_log(self):
+        """Write buffered log rows to disk"""
+        if self._log_fh.closed:
+            return
+        if self._log_buf:
+            self._log_writer.writerows(self._log_buf)
+            self._log_buf.clear()
+        self._log_fh.flush()
+    
+    def shutdown(self):
+        """Flush and close the CSV log"""
+        self.flush_log()
+        self._log_fh.close()
     
     def draw_track(self):
         """Render elevation profile with friction coloring"""
-        if not self.track_profile:
+        if len(self.track_xs) < 2:
             return
         
         # View parameters
@@ -139,33 +198,30 @@ class EcoGearSimulator:
         end_screen_x = self.bike.total_length * scale + offset_x
         pygame.draw.line(self.screen, (0, 0, 0), (start_screen_x, ground_y), (end_screen_x, ground_y), 2)
         
-        # Draw track segments
-        for i in range(1, len(self.track_profile)):
-            x1, y1 = self.track_profile[i-1]
-            x2, y2 = self.track_profile[i]
-            
-            # Screen coordinates
-            screen_x1 = x1 * scale + offset_x
-            screen_x2 = x2 * scale + offset_x
-            screen_y1 = ground_y - y1 * 50
-            screen_y2 = ground_y - y2 * 50
-            
-            # Only draw if visible
-            if screen_x2 < 0 or screen_x1 > SCREEN_WIDTH:
+        # Only keep the points whose connecting lines are visible
+        view_start = max(np.searchsorted(self.track_xs, -offset_x / scale, side='left') - 1, 0)
+        view_end = min(np.searchsorted(self.track_xs, (SCREEN_WIDTH - offset_x) / scale, side='right') + 1,
+                       len(self.track_xs))
+        
+        # Screen coordinates of the visible points, as one (n, 2) array converted in a single call
+        points = np.empty((view_end - view_start, 2))
+        np.multiply(self.track_xs[view_start:view_end], scale, out=points[:, 0])
+        points[:, 0] += offset_x
+        np.multiply(self.track_elevs[view_start:view_end], -50, out=points[:, 1])
+        points[:, 1] += ground_y
+        points = points.tolist()
+        
+        # Friction color bucket at the start of each visible line
+        buckets = self.track_mu_buckets[view_start:view_end - 1]
+        
+        # Draw track segments, one polyline per run of lines with the same color
+        # (red decreases and green increases with mu)
+        run_bounds = [0] + (np.flatnonzero(buckets[1:] != buckets[:-1]) + 1).tolist() + [len(buckets)]
+        for run_start, run_end in zip(run_bounds[:-1], run_bounds[1:]):
+            if run_start == run_end:
                 continue
-            
-            # Get segment properties for coloring
-            _, (_, _, _, mu) = self.bike.get_current_segment(x1)
-            
-            # Color by friction (blue=high mu, red=low mu)
-            color_intensity = min(1.0, max(0.0, mu))
-            color = (
-                int(255 * (1 - color_intensity)),  # Red decreases with mu
-                int(255 * color_intensity),        # Green increases with mu
-                0
-            )
-            
-            pygame.draw.line(self.screen, color, (screen_x1, screen_y1), (screen_x2, screen_y2), 4)
+            color = self._mu_colors[buckets[run_start]]
+            pygame.draw.lines(self.screen, color, False, points[run_start:run_end + 1], 4)
         
         # Draw segment boundaries
         for seg in self.bike.track_segments:
@@ -179,6 +235,18 @@ class EcoGearSimulator:
         if 0 <= finish_x <= SCREEN_WIDTH:
             pygame.draw.line(self.screen, (0, 0, 0), (finish_x, ground_y-30), (finish_x, ground_y+30), 4)
     
+    def build_bike_sprite(self):
+        """Draw the unrotated bicycle sprite"""
+        bike_surface = pygame.Surface((40, 40), pygame.SRCALPHA)
+        cx, cy = 20, 20  # Center of bike surface
+        
+        # Draw bike components
+        pygame.draw.rect(bike_surface, BIKE_COLOR, (cx-10, cy-10, 20, 20))  # Body
+        pygame.draw.circle(bike_surface, (50, 50, 50), (cx-8, cy+15), 6)    # Front wheel
+        pygame.draw.circle(bike_surface, (50, 50, 50), (cx+8, cy+15), 6)    # Rear wheel
+        pygame.draw.circle(bike_surface, (255, 200, 0), (cx, cy-15), 8)     # Rider
+        return bike_surface
+    
     def draw_bike(self):
         """Draw bicycle sprite at current position with proper rotation based on slope"""
         ground_y = 500
@@ -195,24 +263,54 @@ class EcoGearSimulator:
         angle = math.degrees(math.atan(visual_slope))
         angle = max(-max_rotation, min(max_rotation, angle))
         
-        # Create bike surface
-        bike_surface = pygame.Surface((40, 40), pygame.SRCALPHA)
-        cx, cy = 20, 20  # Center of bike surface
-        
-        # Draw bike components
-        pygame.draw.rect(bike_surface, BIKE_COLOR, (cx-10, cy-10, 20, 20))  # Body
-        pygame.draw.circle(bike_surface, (50, 50, 50), (cx-8, cy+15), 6)    # Front wheel
-        pygame.draw.circle(bike_surface, (50, 50, 50), (cx+8, cy+15), 6)    # Rear wheel
-        pygame.draw.circle(bike_surface, (255, 200, 0), (cx, cy-15), 8)     # Rider
-        
         # Rotate bike surface
-        rotated_bike = pygame.transform.rotate(bike_surface, angle)
+        angle = round(angle)
+        rotated_bike = self._rotated_bikes.get(angle)
+        if rotated_bike is None:
+            rotated_bike = pygame.transform.rotate(self._bike_base, angle)
+            self._rotated_bikes[angle] = rotated_bike
         rotated_rect = rotated_bike.get_rect()
         rotated_rect.center = (bike_x, bike_y)
         
         # Draw rotated bike
         self.screen.blit(rotated_bike, rotated_rect)
     
+    def _cached_render(self, font, text, color):
+        """Render text with antialiasing, reusing the surface if the same text was rendered recently"""
+        key = (text, color, id(font))
+        surface = self._text_cache.get(key)
+        if surface is None:
+            surface = font.render(text, True, color)
+            self._text_cache[key] = surface
+            if len(self._text_cache) > TEXT_CACHE_SIZE:
+                self._text_cache.popitem(last=False)
+        else:
+            self._text_cache.move_to_end(key)
+        return surface
+    
+    def wrap_status(self, status_msg, max_width):
+        """Word-wrap a status message to max_width pixels (cached, status messages rarely change)"""
+        key = (status_msg, max_width)
+        status_lines = self._wrapped_status.get(key)
+        if status_lines is not None:
+            return status_lines
+        
+        status_lines = []
+        words = status_msg.split()
+        current_line = ""
+        
+        for word in words:
+            test_line = current_line + word + " "
+            if self.font.size(test_line)[0] < max_width:
+                current_line = test_line
+            else:
+                status_lines.append(current_line)
+                current_line = word + " "
+        status_lines.append(current_line)
+        
+        self._wrapped_status[key] = status_lines
+        return status_lines
+    
     def draw_dashboard(self):
         """Render real-time metrics with improved aesthetics and proper text wrapping"""
         state = self.bike.get_state()
@@ -234,35 +332,35 @@ class EcoGearSimulator:
         
         # Score display - now increases with progress
         score_color = (0, 150, 0) if score > 0 else (200, 0, 0)
-        score_text = self.font.render(f"SCORE: {score:,.0f}", True, score_color)
+        score_text = self._cached_render(self.font, f"SCORE: {score:,.0f}", score_color)
         self.screen.blit(score_text, (20, 25))
         
         # Energy display
         energy_color = WARNING_COLOR if state['total_energy'] > 50000 else TEXT_COLOR
-        energy_text = self.monospace_font.render(f"ENERGY: {state['total_energy']:,.0f} J", True, energy_color)
+        energy_text = self._cached_render(self.monospace_font, f"ENERGY: {state['total_energy']:,.0f} J", energy_color)
         self.screen.blit(energy_text, (20, 60))
         
         # Time display
         time_color = ALERT_COLOR if state['time_limit_exceeded'] else TEXT_COLOR
-        time_text = self.monospace_font.render(
+        time_text = self._cached_render(
+            self.monospace_font,
             f"TIME: {state['total_time']:.1f}s / {TIME_LIMIT:.1f}s", 
-            True, 
             time_color
         )
         self.screen.blit(time_text, (20, 90))
         
         # Gear display
-        gear_text = self.monospace_font.render(f"GEAR: {state['gear_ratio']:.2f}", True, TEXT_COLOR)
+        gear_text = self._cached_render(self.monospace_font, f"GEAR: {state['gear_ratio']:.2f}", TEXT_COLOR)
         self.screen.blit(gear_text, (20, 120))
         
         # Slip counter
         slip_color = ALERT_COLOR if state['slip_count'] > 50 else TEXT_COLOR
-        slip_text = self.monospace_font.render(f"SLIP COUNT: {state['slip_count']}", True, slip_color)
+        slip_text = self._cached_render(self.monospace_font, f"SLIP COUNT: {state['slip_count']}", slip_color)
         self.screen.blit(slip_text, (20, 150))
         
         # Position and velocity
-        pos_text = self.monospace_font.render(f"POSITION: {state['x']:.1f}m", True, TEXT_COLOR)
-        vel_text = self.monospace_font.render(f"VELOCITY: {state['v']:.2f} m/s", True, TEXT_COLOR)
+        pos_text = self._cached_render(self.monospace_font, f"POSITION: {state['x']:.1f}m", TEXT_COLOR)
+        vel_text = self._cached_render(self.monospace_font, f"VELOCITY: {state['v']:.2f} m/s", TEXT_COLOR)
         self.screen.blit(pos_text, (20, 180))
         self.screen.blit(vel_text, (20, 210))
         
@@ -274,28 +372,28 @@ class EcoGearSimulator:
         pygame.draw.rect(self.screen, (0, 0, 0), progress_bar, 1)
         
         # Position label
-        pos_label = self.small_font.render(f"Progress: {progress*100:.1f}%", True, TEXT_COLOR)
+        pos_label = self._cached_render(self.small_font, f"Progress: {progress*100:.1f}%", TEXT_COLOR)
         self.screen.blit(pos_label, (150, 248))
         
         # Next segment warning
         next_seg = self.bike.get_next_segment()
         if next_seg:
-            next_text = self.small_font.render(
+            next_text = self._cached_render(
+                self.small_font,
                 f"NEXT: {next_seg[0]:.0f}-{next_seg[1]:.0f}m | Slope={next_seg[2]:.2f} | μ={next_seg[3]:.2f}", 
-                True, 
                 WARNING_COLOR
             )
             # Check if text is too long and wrap if necessary
             if next_text.get_width() > dashboard_width - 40:
                 # Split into two lines if too long
-                part1 = self.small_font.render(
+                part1 = self._cached_render(
+                    self.small_font,
                     f"NEXT: {next_seg[0]:.0f}-{next_seg[1]:.0f}m | Slope={next_seg[2]:.2f}", 
-                    True, 
                     WARNING_COLOR
                 )
-                part2 = self.small_font.render(
+                part2 = self._cached_render(
+                    self.small_font,
                     f"μ={next_seg[3]:.2f}", 
-                    True, 
                     WARNING_COLOR
                 )
                 self.screen.blit(part1, (20, 275))
@@ -304,7 +402,7 @@ class EcoGearSimulator:
                 self.screen.blit(next_text, (20, 275))
         else:
             # If no next segment, show finish line info
-            finish_text = self.small_font.render("FINISH LINE AHEAD!", True, SUCCESS_COLOR)
+            finish_text = self._cached_render(self.small_font, "FINISH LINE AHEAD!", SUCCESS_COLOR)
             self.screen.blit(finish_text, (20, 275))
         
         # Status message - handle long messages
@@ -320,30 +418,19 @@ class EcoGearSimulator:
             status_color = TEXT_COLOR
         
         # Wrap status message if too long
-        status_lines = []
-        words = status_msg.split()
-        current_line = ""
-        
-        for word in words:
-            test_line = current_line + word + " "
-            if self.font.size(test_line)[0] < dashboard_width - 40:
-                current_line = test_line
-            else:
-                status_lines.append(current_line)
-                current_line = word + " "
-        status_lines.append(current_line)
+        status_lines = self.wrap_status(status_msg, dashboard_width - 40)
         
         # Draw status lines
         y_pos = 305
         for line in status_lines:
-            status_text = self.font.render(line.strip(), True, status_color)
+            status_text = self._cached_render(self.font, line.strip(), status_color)
             self.screen.blit(status_text, (20, y_pos))
             y_pos += 28
         
         # Logging status
         log_status = "LOGGING: ON" if self.logging_enabled else "LOGGING: OFF"
         log_color = (0, 150, 0) if self.logging_enabled else (150, 150, 150)
-        log_text = self.small_font.render(f"{log_status} (Press L to toggle)", True, log_color)
+        log_text = self._cached_render(self.small_font, f"{log_status} (Press L to toggle)", log_color)
         
         # Place logging text below status messages
         self.screen.blit(log_text, (20, y_pos + 10))
@@ -387,7 +474,7 @@ class EcoGearSimulator:
         
         y_pos = 100
         for line in help_lines:
-            text = self.font.render(line, True, (0, 0, 0))
+            text = self._cached_render(self.font, line, (0, 0, 0))
             self.screen.blit(text, (100, y_pos))
             y_pos += 35
     
@@ -413,9 +500,41 @@ class EcoGearSimulator:
         
         return True
     
+    def step_physics(self):
+        """Advance the simulation by one fixed physics step"""
+        # Prepare track_info for controller
+        if self.bike.segment_changed:
+            self._track_info['next_segment'] = self.bike.get_next_segment()
+        track_info = self._track_info
+        
+        # Get gear ratio from controller
+        try:
+            gear_ratio = self.controller.get_gear_ratio(
+                self.bike.x,
+                self.bike.v,
+                self.bike.current_slope,
+                self.bike.current_mu,
+                track_info
+            )
+            # Validate and clamp gear ratio
+            gear_ratio = float(gear_ratio)
+            gear_ratio = max(0.0, min(5.0, gear_ratio))
+        except Exception as e:
+            print(f"Controller error: {e}")
+            gear_ratio = 1.0  # Safe default
+        
+        # Update physics
+        self.bike.update(gear_ratio, PHYSICS_DT)
+        self.log_step()
+        
+        # Persist the log as soon as the run ends
+        if self.bike.completed or self.bike.failed:
+            self.flush_log()
+    
     def run(self):
-        """Main simulation loop"""
+        """Main simulation loop (fixed-step physics, rendering capped at RENDER_FPS)"""
         running = True
+        accumulated_time = 0.0  # Real time not yet simulated (s)
         
         while running:
             # Handle events
@@ -423,35 +542,14 @@ class EcoGearSimulator:
             if not running:
                 break
             
-            # Physics update
-            if not self.paused and not (self.bike.completed or self.bike.failed):
-                # Prepare track_info for controller
-                track_info = {
-                    'segments': self.bike.track_segments,
-                    'next_segment': self.bike.get_next_segment(),
-                    'finish_line': self.bike.total_length
-                }
-                
-                # Get gear ratio from controller
-                try:
-                    gear_ratio = self.controller.get_gear_ratio(
-                        self.bike.x,
-                        self.bike.v,
-                        self.bike.current_slope,
-                        self.bike.current_mu,
-                        track_info
-                    )
-                    # Validate and clamp gear ratio
-                    gear_ratio = float(gear_ratio)
-                    gear_ratio = max(0.0, min(5.0, gear_ratio))
-                except Exception as e:
-                    print(f"Controller error: {e}")
-                    gear_ratio = 1.0  # Safe default
-                
-                # Update physics
-                state = self.bike.update(gear_ratio, 0.01)
-                if state:
-                    self.log_step(state)
+            # Physics update: as many fixed steps as the elapsed real time covers
+            if not self.paused:
+                steps_needed = min(int(accumulated_time / PHYSICS_DT), MAX_STEPS_PER_FRAME)
+                accumulated_time -= steps_needed * PHYSICS_DT
+                for _ in range(steps_needed):
+                    if self.bike.completed or self.bike.failed:
+                        break
+                    self.step_physics()
             
             # Rendering
             self.screen.fill(BG_COLOR)
@@ -461,8 +559,14 @@ class EcoGearSimulator:
             self.draw_help()
             
             pygame.display.flip()
-            self.clock.tick(100)  # 100 FPS = 0.01s timestep
+            frame_time = self.clock.tick(RENDER_FPS) / 1000.0
+            if self.paused or self.bike.completed or self.bike.failed:
+                accumulated_time = 0.0
+            else:
+                # Drop whatever the step cap could not catch up on
+                accumulated_time = min(accumulated_time + frame_time, MAX_STEPS_PER_FRAME * PHYSICS_DT)
         
+        self.shutdown()
         pygame.quit()
         sys.exit()
 
@@ -1,5 +1,78 @@
+import math
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional: without it the force kernel runs as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# Magic Formula shape coefficients
+# (evaluated exactly rather than from a lookup table: interpolation error would shift
+# total_energy, and scores must not depend on how the curve is evaluated)
+TIRE_B = 10.0
+TIRE_C = 1.9
+
+
+@njit("float64(float64, float64, float64)", cache=True)
+def _tire_force(slip_ratio, normal_force, mu):
+    """
+    Calculate tire traction force using a simplified Magic Formula.
+    Fx = D * sin(C * arctan(B * SR))
+    """
+    D = mu * normal_force
+    return D * math.sin(TIRE_C * math.atan(TIRE_B * slip_ratio))
+
+
+# Explicit float64 signature: compiled once at import, and int arguments
+# (e.g. T_input) are converted instead of triggering another specialization
+@njit("UniTuple(float64, 7)(" + ", ".join(["float64"] * 12) + ")", cache=True)
+def _compute_forces(v, omega, N, F_gravity, mu, gear_ratio, m, R, I, T_input, C_rr, drag_k):
+    """
+    Force kernel behind BicyclePhysics.calculate_forces, on plain floats.
+    N and F_gravity are the normal force and gravity component for the current slope.
+    Returns (F_net, F_x_rear, alpha_rear, F_roll, F_drag, F_x_front, slip_ratio)
+    """
+    # Calculate Slip Ratio
+    # SR = (omega * R - v) / |v| (with epsilon)
+    v_safe = max(abs(v), 0.1) # Avoid div by zero
+    slip_ratio = (omega * R - v) / v_safe
+    
+    # Calculate Rear Traction Fx_rear
+    F_x_rear = _tire_force(slip_ratio, N, mu)
+    
+    # Calculate Rear Wheel Dynamics
+    # I * alpha = tau - Fx * R
+    tau = T_input * gear_ratio if gear_ratio > 0 else 0.0
+    alpha_rear = (tau - F_x_rear * R) / I
+    
+    # Forces on Body (v is kept >= 0 by update, so roll and drag always oppose +x)
+    F_roll = -C_rr * N
+    F_drag = -drag_k * v * v
+    
+    # F_net_static (excluding front wheel dynamic drag)
+    F_net_static = F_x_rear + F_gravity + F_roll + F_drag
+    
+    # Effective Mass for linear acceleration
+    # F_net_static = (m + I/R^2) * a
+    m_eff = m + (I / R**2)
+    a_bike = F_net_static / m_eff
+    
+    # Back calculate F_x_front (Front wheel drag due to spin up)
+    # I * alpha_front = F_x_front * R
+    # alpha_front = a_bike / R (assuming no slip)
+    # F_x_front = I * a_bike / R^2
+    F_x_front = (I * a_bike) / (R**2)
+    
+    # True Net Force on Body (m * a)
+    F_net = F_net_static - F_x_front
+    
+    return F_net, F_x_rear, alpha_rear, F_roll, F_drag, F_x_front, slip_ratio
+
+
 class BicyclePhysics:
     def __init__(self, track_segments, time_limit):
         # Constants
@@ -12,10 +85,19 @@ class BicyclePhysics:
         self.rho = 1.2      # kg/m^3 (air density)
         self.C_d = 0.9      # Drag coefficient
         self.A = 0.5        # m^2 (frontal area)
+        self._drag_k = 0.5 * self.rho * self.C_d * self.A  # Aerodynamic drag factor (F_drag = -k * v^2)
         
-        # Track setup
-        self.track_segments = track_segments
-        self.total_length = max(seg[1] for seg in track_segments)
+        # Track setup (segment fields stored as separate arrays for fast lookups)
+        seg_data = np.array(track_segments, dtype=np.float64).reshape(-1, 4)
+        self.seg_starts = np.ascontiguousarray(seg_data[:, 0])
+        self.seg_ends = np.ascontiguousarray(seg_data[:, 1])
+        self.seg_slopes = np.ascontiguousarray(seg_data[:, 2])
+        self.seg_mus = np.ascontiguousarray(seg_data[:, 3])
+        self._track_segments = list(zip(
+            self.seg_starts.tolist(), self.seg_ends.tolist(),
+            self.seg_slopes.tolist(), self.seg_mus.tolist()
+        ))
+        self.total_length = float(self.seg_ends.max())
         
         # State variables
         self.reset()
@@ -33,115 +115,104 @@ class BicyclePhysics:
         self.failed = False
         self.time_limit_exceeded = False
         self.last_segment_idx = -1
+        self.segment_changed = True  # Whether the last update moved into a new segment
+        self._cur_start = 0.0  # Bounds of the cached segment (empty until first lookup)
+        self._cur_end = 0.0
         self.current_slope = 0.0
         self.current_mu = 0.8
+        self._normal_force = self.m * self.g  # Normal force and gravity component for current_slope
+        self._F_gravity = 0.0
         self.gear_ratio = 1.0
         self.slip_event = False
-        self.forces = {
-            'drive': 0.0,
-            'gravity': 0.0,
-            'drag': 0.0,
-            'roll': 0.0,
-            'front_dynamic_drag': 0.0
-        }
+        self.energy_step = 0.0  # Energy consumed by the last update (J)
+        # Forces from the last update (N)
+        self.F_drive = 0.0
+        self.F_gravity = 0.0
+        self.F_drag = 0.0
+        self.F_roll = 0.0
+        self.F_front_drag = 0.0  # Front wheel dynamic drag
         
+    @property
+    def track_segments(self):
+        """Track segments as (start, end, slope, mu) tuples, in the format given to the controller"""
+        return self._track_segments
+    
     def get_current_segment(self, x):
         """Find segment containing position x"""
-        for i, (start, end, slope, mu) in enumerate(self.track_segments):
-            if start <= x < end:
-                return i, (start, end, slope, mu)
-        return len(self.track_segments)-1, self.track_segments[-1]
+        idx = int(np.searchsorted(self.seg_starts, x, side='right')) - 1
+        if idx < 0 or x >= self.seg_ends[idx]:
+            idx = len(self.seg_starts) - 1
+        return idx, self._track_segments[idx]
+    
+    def get_segment_indices(self, xs):
+        """Find segment index for every position in the array xs"""
+        idxs = np.searchsorted(self.seg_starts, xs, side='right') - 1
+        outside = (idxs < 0) | (xs >= self.seg_ends[idxs])
+        idxs[outside] = len(self.seg_starts) - 1
+        return idxs
     
     def get_next_segment(self):
         """Get next segment info if available"""
         current_idx, _ = self.get_current_segment(self.x)
-        if current_idx < len(self.track_segments) - 1:
-            return self.track_segments[current_idx + 1]
+        if current_idx < len(self.seg_starts) - 1:
+            return self._track_segments[current_idx + 1]
         return None
     
-    def update_elevation(self, dx):
-        """Update elevation based on slope"""
-        segment_idx, (start, end, slope, mu) = self.get_current_segment(self.x)
+    def refresh_segment(self):
+        """Update cached segment properties, rescanning only when x leaves the cached segment"""
+        if self._cur_start <= self.x < self._cur_end:
+            return
+        segment_idx, segment = self.get_current_segment(self.x)
+        self._cur_start, self._cur_end, self.current_slope, self.current_mu = segment
+        # Slope-dependent forces are constant within a segment
+        # (cos(atan(s)) = 1 / sqrt(1 + s^2), sin(atan(s)) = s / sqrt(1 + s^2))
+        weight_scale = self.m * self.g / math.sqrt(1.0 + self.current_slope * self.current_slope)
+        self._normal_force = weight_scale
+        self._F_gravity = -weight_scale * self.current_slope
         if segment_idx != self.last_segment_idx:
             self.last_segment_idx = segment_idx
-            self.current_slope = slope
-            self.current_mu = mu
-            
-        self.elevation += slope * dx
+            self.segment_changed = True
+    
+    def update_elevation(self, dx):
+        """Update elevation based on slope"""
+        self.refresh_segment()
+        self.elevation += self.current_slope * dx
 
     def get_tire_force(self, slip_ratio, normal_force, mu):
         """
         Calculate tire traction force using a simplified Magic Formula.
         Fx = D * sin(C * arctan(B * SR))
         """
-        D = mu * normal_force
-        B = 10.0
-        C = 1.9
-        return D * np.sin(C * np.arctan(B * slip_ratio))
+        return _tire_force(slip_ratio, normal_force, mu)
     
     def calculate_forces(self, gear_ratio):
         """Calculate all forces acting on the bike"""
-        # Normal force
-        theta = np.arctan(self.current_slope)
-        N = self.m * self.g * np.cos(theta)
-        
-        # Calculate Slip Ratio
-        # SR = (omega * R - v) / |v| (with epsilon)
-        v_safe = max(abs(self.v), 0.1) # Avoid div by zero
-        slip_ratio = (self.omega * self.R - self.v) / v_safe
-        
-        # Calculate Rear Traction Fx_rear
-        F_x_rear = self.get_tire_force(slip_ratio, N, self.current_mu)
-        
-        # Calculate Rear Wheel Dynamics
-        # I * alpha = tau - Fx * R
-        tau = self.T_input * gear_ratio if gear_ratio > 0 else 0.0
-        alpha_rear = (tau - F_x_rear * self.R) / self.I
-        
-        # Forces on Body
-        F_gravity = -self.m * self.g * np.sin(theta)
-        F_roll = -self.C_rr * N * np.sign(self.v + 1e-5)
-        F_drag = -0.5 * self.rho * self.C_d * self.A * self.v**2 * np.sign(self.v + 1e-5)
-        
-        # F_net_static (excluding front wheel dynamic drag)
-        F_net_static = F_x_rear + F_gravity + F_roll + F_drag
-        
-        # Effective Mass for linear acceleration
-        # F_net_static = (m + I/R^2) * a
-        m_eff = self.m + (self.I / self.R**2)
-        a_bike = F_net_static / m_eff
-        
-        # Back calculate F_x_front (Front wheel drag due to spin up)
-        # I * alpha_front = F_x_front * R
-        # alpha_front = a_bike / R (assuming no slip)
-        # F_x_front = I * a_bike / R^2
-        F_x_front = (self.I * a_bike) / (self.R**2)
-        
-        # True Net Force on Body (m * a)
-        F_net = F_net_static - F_x_front
+        F_net, F_x_rear, alpha_rear, F_roll, F_drag, F_x_front, slip_ratio = _compute_forces(
+            self.v, self.omega, self._normal_force, self._F_gravity, self.current_mu, gear_ratio,
+            self.m, self.R, self.I, self.T_input, self.C_rr, self._drag_k
+        )
         
         # Check for slip event (threshold based)
         self.slip_event = abs(slip_ratio) > 0.15 # Threshold for "excessive slip"
         if self.slip_event and gear_ratio > 0:
              self.slip_count += 1
         
-        self.forces = {
-            'drive': F_x_rear,
-            'gravity': F_gravity,
-            'drag': F_drag,
-            'roll': F_roll,
-            'front_dynamic_drag': F_x_front
-        }
+        self.F_drive = F_x_rear
+        self.F_gravity = self._F_gravity
+        self.F_drag = F_drag
+        self.F_roll = F_roll
+        self.F_front_drag = F_x_front
         
         return F_net, F_x_rear, alpha_rear
     
     def update(self, gear_ratio, dt):
-        """Update physics state"""
+        """Update physics state (results are read back from the attributes, see get_state)"""
         if self.completed or self.failed:
             return
         
         self.gear_ratio = gear_ratio
         self.total_time += dt
+        self.segment_changed = False
         
         # Check time limit
         if self.total_time > self.time_limit:
@@ -150,20 +221,20 @@ class BicyclePhysics:
             return
         
         # Get current segment properties
-        _, (_, _, self.current_slope, self.current_mu) = self.get_current_segment(self.x)
+        self.refresh_segment()
         
         # Calculate forces
         F_net, F_drive, alpha_rear = self.calculate_forces(gear_ratio)
         
         # Energy consumption (only when driving)
-        energy_step = 0.0
+        self.energy_step = 0.0
         if gear_ratio > 0:
             # Power = Torque * Omega
             power = (self.T_input * gear_ratio) * self.omega
             # Ensure power is non-negative (engine doesn't absorb energy)
             power = max(0.0, power)
-            energy_step = power * dt
-            self.total_energy += energy_step
+            self.energy_step = power * dt
+            self.total_energy += self.energy_step
         
         # Update velocity and position
         a = F_net / self.m
@@ -174,9 +245,9 @@ class BicyclePhysics:
         
         # Prevent negative velocity/omega (simple constraint for this simulation)
         if self.v < 0:
-            self.v = 0
+            self.v = 0.0
         if self.omega < 0:
-            self.omega = 0
+            self.omega = 0.0
         
         dx = self.v * dt
         self.x += dx
@@ -196,29 +267,6 @@ class BicyclePhysics:
         # Check slip limit (REMOVED: Slip is now a natural part of the physics model)
         # if self.slip_count > 5:
         #    self.failed = True
-        
-        return {
-            'x': self.x,
-            'v': self.v,
-            'elevation': self.elevation,
-            'total_time': self.total_time,
-            'total_energy': self.total_energy,
-            'slip_count': self.slip_count,
-            'completed': self.completed,
-            'failed': self.failed,
-            'time_limit_exceeded': self.time_limit_exceeded,
-            'gear_ratio': self.gear_ratio,
-            'slip_event': self.slip_event,
-            'energy_step': energy_step,
-            'segment_idx': self.last_segment_idx,
-            'slope': self.current_slope,
-            'mu': self.current_mu,
-            'forces': self.forces,
-            'F_drive': self.forces['drive'],
-            'F_gravity': self.forces['gravity'],
-            'F_drag': self.forces['drag'],
-            'F_roll': self.forces['roll']
-        }
     
     def get_state(self):
         """Get current state for logging"""
@@ -236,8 +284,8 @@ class BicyclePhysics:
             'segment_idx': self.last_segment_idx,
             'slope': self.current_slope,
             'mu': self.current_mu,
-            'F_drive': self.forces['drive'],
-            'F_gravity': self.forces['gravity'],
-            'F_drag': self.forces['drag'],
-            'F_roll': self.forces['roll']
+            'F_drive': self.F_drive,
+            'F_gravity': self.F_gravity,
+            'F_drag': self.F_drag,
+            'F_roll': self.F_roll
         }
\ No newline at end of file